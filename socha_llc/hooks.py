@@ -145,6 +145,17 @@ app_license = "mit"
 # 	}
 # }
 
+doc_events = {
+	"GL Entry": {
+		"on_submit": "socha_llc.socha_llc.report.custom_profit_and_loss_statement.custom_profit_and_loss_statement.clear_report_cache",
+	},
+	"Account": {
+		"on_update": "socha_llc.socha_llc.report.custom_profit_and_loss_statement.custom_profit_and_loss_statement.clear_report_cache",
+		"after_rename": "socha_llc.socha_llc.report.custom_profit_and_loss_statement.custom_profit_and_loss_statement.clear_report_cache",
+		"on_trash": "socha_llc.socha_llc.report.custom_profit_and_loss_statement.custom_profit_and_loss_statement.clear_report_cache",
+	},
+}
+
 # Scheduled Tasks
 # ---------------
 
@@ -1,6 +1,9 @@
 # Copyright (c) 2024, Socha LLC and contributors
 # For license information, please see license.txt
 
+import hashlib
+from itertools import chain
+
 import frappe
 from frappe import _
 from frappe.utils import cint, flt
@@ -12,93 +15,34 @@ from erpnext.accounts.report.financial_statements import (
 	get_period_list,
 )
 
+BALANCE_SHEET_ROOT_TYPES = (("Asset", "Debit"), ("Liability", "Credit"), ("Equity", "Credit"))
+PROFIT_AND_LOSS_ROOT_TYPES = (("Income", "Credit"), ("Expense", "Debit"))
 
-def execute(filters=None):
-	period_list = get_period_list(
-		filters.from_fiscal_year,
-		filters.to_fiscal_year,
-		filters.period_start_date,
-		filters.period_end_date,
-		filters.filter_based_on,
-		filters.periodicity,
-		company=filters.company,
-	)
+REPORT_CACHE_PREFIX = "custom_profit_and_loss_statement"
+REPORT_CACHE_EXPIRY = 300
 
-	filters.period_start_date = period_list[0]["year_start_date"]
+
+def execute(filters=None):
+	period_list, data_by_root_type = get_report_data(filters)
 
 	currency = filters.presentation_currency or frappe.get_cached_value(
 		"Company", filters.company, "default_currency"
 	)
 
-	asset = get_data(
-		filters.company,
-		"Asset",
-		"Debit",
-		period_list,
-		only_current_fiscal_year=False,
-		filters=filters,
-		accumulated_values=filters.accumulated_values,
-	)
-
-	liability = get_data(
-		filters.company,
-		"Liability",
-		"Credit",
-		period_list,
-		only_current_fiscal_year=False,
-		filters=filters,
-		accumulated_values=filters.accumulated_values,
-	)
-
-	equity = get_data(
-		filters.company,
-		"Equity",
-		"Credit",
-		period_list,
-		only_current_fiscal_year=False,
-		filters=filters,
-		accumulated_values=filters.accumulated_values,
-	)
-	income = get_data(
-		filters.company,
-		"Income",
-		"Credit",
-		period_list,
-		filters=filters,
-		accumulated_values=filters.accumulated_values,
-		ignore_closing_entries=True,
-		ignore_accumulated_values_for_fy=True,
-	)
-
-	expense = get_data(
-		filters.company,
-		"Expense",
-		"Debit",
-		period_list,
-		filters=filters,
-		accumulated_values=filters.accumulated_values,
-		ignore_closing_entries=True,
-		ignore_accumulated_values_for_fy=True,
-	)
+	asset, liability, equity, income, expense = data_by_root_type.values()
 
 	message, opening_balance = check_opening_balance(asset, liability, equity, income, expense)
 
-	data = []
-	data.extend(asset or [])
-	data.extend(liability or [])
-	data.extend(equity or [])
-	data.extend(income or [])
-	data.extend(expense or [])
+	data = list(chain.from_iterable(rows or () for rows in data_by_root_type.values()))
 	if opening_balance and round(opening_balance, 2) != 0:
+		unclosed_label = "'" + _("Unclosed Fiscal Years Profit / Loss (Credit)") + "'"
 		unclosed = {
-			"account_name": "'" + _("Unclosed Fiscal Years Profit / Loss (Credit)") + "'",
-			"account": "'" + _("Unclosed Fiscal Years Profit / Loss (Credit)") + "'",
+			"account_name": unclosed_label,
+			"account": unclosed_label,
 			"warn_if_negative": True,
 			"currency": currency,
 		}
-		for period in period_list:
-			unclosed[period.key] = opening_balance
-
+		unclosed.update(dict.fromkeys((period.key for period in period_list), opening_balance))
 		unclosed["total"] = opening_balance
 		data.append(unclosed)
 
@@ -108,6 +52,12 @@ def execute(filters=None):
 
 	columns = get_difference_columns(columns, filters)
 
+	# Nothing to compare, chart or summarise
+	if not data:
+		return columns, data, message
+
+	# Chart and summary must read the rows before get_difference_data adds keys to them
+	# (the summary relies on the blank separator row being empty), so these run in order.
 	chart = get_chart_data(filters, columns, asset, liability, equity, income, expense, currency)
 
 	report_summary, primitive_summary = get_report_summary(
@@ -119,143 +69,231 @@ def execute(filters=None):
 	return columns, data, message, chart, report_summary, primitive_summary
 
 
+def get_report_data(filters):
+	"""Return the period list and root type rows, reusing a recent result for the same filters."""
+	cache_key = get_report_cache_key(filters)
+	cached_data = frappe.cache().get_value(cache_key, expires=True)
+
+	if not cached_data:
+		period_list = get_period_list(
+			filters.from_fiscal_year,
+			filters.to_fiscal_year,
+			filters.period_start_date,
+			filters.period_end_date,
+			filters.filter_based_on,
+			filters.periodicity,
+			company=filters.company,
+		)
+		filters.period_start_date = period_list[0]["year_start_date"]
+		data_by_root_type = get_root_type_data(filters, period_list)
+		frappe.cache().set_value(
+			cache_key, (period_list, data_by_root_type), expires_in_sec=REPORT_CACHE_EXPIRY
+		)
+		return period_list, data_by_root_type
+
+	period_list, data_by_root_type = cached_data
+	filters.period_start_date = period_list[0]["year_start_date"]
+
+	return period_list, data_by_root_type
+
+
+def get_report_cache_key(filters):
+	# Rows carry translated account names and period labels, and the version moves on every posting
+	filters_hash = hashlib.sha1(frappe.as_json(filters).encode()).hexdigest()
+	version = cint(frappe.cache().get(get_report_cache_version_key(filters.company)))
+	return f"{REPORT_CACHE_PREFIX}:{filters.company}:{frappe.local.lang}:{version}:{filters_hash}"
+
+
+def get_report_cache_version_key(company):
+	return frappe.cache().make_key(f"{REPORT_CACHE_PREFIX}_version:{company}")
+
+
+def clear_report_cache(doc, method=None, *args):
+	"""Invalidate cached report data of the document's company once the transaction commits."""
+	companies = frappe.flags.report_cache_companies_to_clear
+	if companies is None:
+		# Bumping before commit would let a concurrent run cache the old ledger under the new version
+		companies = frappe.flags.report_cache_companies_to_clear = set()
+		frappe.db.after_commit.add(bump_report_cache_versions)
+		frappe.db.after_rollback.add(discard_report_cache_versions)
+
+	companies.add(doc.company)
+
+
+def bump_report_cache_versions():
+	for company in frappe.flags.pop("report_cache_companies_to_clear", None) or ():
+		frappe.cache().incr(get_report_cache_version_key(company))
+
+
+def discard_report_cache_versions():
+	frappe.flags.pop("report_cache_companies_to_clear", None)
+
+
+def get_root_type_data(filters, period_list):
+	"""Return the report rows of every root type, keyed by root type in display order."""
+	# Balance sheet root types include closing entries, profit and loss ones do not
+	balance_sheet_args = dict(
+		only_current_fiscal_year=False,
+		filters=filters,
+		accumulated_values=filters.accumulated_values,
+	)
+	profit_and_loss_args = dict(
+		filters=filters,
+		accumulated_values=filters.accumulated_values,
+		ignore_closing_entries=True,
+		ignore_accumulated_values_for_fy=True,
+	)
+
+	data_by_root_type = {}
+	for root_types, kwargs in (
+		(BALANCE_SHEET_ROOT_TYPES, balance_sheet_args),
+		(PROFIT_AND_LOSS_ROOT_TYPES, profit_and_loss_args),
+	):
+		for root_type, balance_must_be in root_types:
+			data_by_root_type[root_type] = get_data(
+				filters.company, root_type, balance_must_be, period_list, **kwargs
+			)
+
+	return data_by_root_type
+
+
 def get_difference_data(columns, data):
-    diff_w_columns = []
-    percent_diff_columns = []
-
-    # Extracting columns for differences and percentage differences
-    for column in columns:
-        fieldname = column.get("fieldname")
-        if not fieldname:
-            continue
-        if "diff_with_" in fieldname:
-            diff_w_columns.append(fieldname)
-        elif "percent_with_" in fieldname:
-            percent_diff_columns.append(fieldname)
-
-
-    for row in data:
-        for col in diff_w_columns:
-            try:
-                months = col.split("diff_with_")[1].split("_and_")
-                old_value = float(row.get(months[0], 0) or 0)
-                new_value = float(row.get(months[1], 0) or 0)
-                row[col] = new_value - old_value
-            except (IndexError, ValueError, TypeError) as e:
-                frappe.msgprint(f"Error calculating difference for {col}: {e}")
-                row[col] = None
-
-    for row in data:
-        for col in percent_diff_columns:
-            try:
-                months = col.split("percent_with_")[1].split("_and_")
-                old_value = float(row.get(months[0], 0) or 0)
-                new_value = float(row.get(months[1], 0) or 0)
-                row[col] = calculate_percentage_difference(old_value, new_value)
-            except (IndexError, ValueError, TypeError) as e:
-                frappe.msgprint(f"Error calculating percentage for {col}: {e}")
-                row[col] = None
-
-    return data
+	difference_specs = []
 
+	# Difference columns carry their source fieldnames, see get_difference_columns
+	for column in columns:
+		old, new = column.get("from_fieldname"), column.get("to_fieldname")
+		if not (old and new):
+			continue
+		if column.get("fieldtype") == "Percent":
+			difference_specs.append((column["fieldname"], old, new, calculate_percentage_difference))
+		else:
+			difference_specs.append((column["fieldname"], old, new, calculate_difference))
 
-def calculate_percentage_difference(old_value, new_value):
-    """
-    Calculate percentage difference between old_value and new_value.
-    """
-    if old_value == 0:
-        if new_value == 0:
-            return 0 
-        return 100  
+	for row in data:
+		# A single bulk update grows each row dict once rather than once per new key
+		row.update({
+			col: calculate(get_numeric_value(row, old), get_numeric_value(row, new))
+			for col, old, new, calculate in difference_specs
+		})
 
-    try:
-        return round(((new_value - old_value) / old_value) * 100, 2)
-    except Exception as e:
-        frappe.msgprint(f"Error in percentage calculation: {e}")
-        return None
+	return data
 
 
+def get_numeric_value(row, fieldname):
+	"""Return the cell as a number, treating missing and empty values as 0."""
+	value = row.get(fieldname)
+	if isinstance(value, (int, float)):
+		return value
+	return float(value) if value else 0.0
+
+
+def calculate_difference(old_value, new_value):
+	return new_value - old_value
+
+
+def calculate_percentage_difference(old_value, new_value):
+	"""
+	Calculate percentage difference between old_value and new_value.
+	"""
+	if not old_value:
+		return 100 if new_value else 0
+
+	return round((new_value - old_value) / old_value * 100, 2)
+
 
 def get_difference_columns(columns, filters):
-	flag = False
-	old_value = {}
-	columns_new = []
+	show_difference = filters.get("show_difference")
+	if show_difference not in ("Monthly", "Yearly"):
+		return columns
+
+	# Difference columns only follow the first currency column
+	first_currency = next(
+		(i for i, row in enumerate(columns) if row.get("fieldtype") == "Currency"), len(columns)
+	)
+
+	if show_difference == "Yearly":
+		previous_year_columns = get_previous_year_columns(columns)
+		compared_columns = [previous_year_columns.get(row.get("fieldname")) for row in columns]
+	else:
+		compared_columns = [None] + [(row.get("fieldname"), row.get("label")) for row in columns[:-1]]
+
+	return list(
+		chain.from_iterable(
+			expand_difference_columns(row, compared_columns[i]) if i > first_currency else (row,)
+			for i, row in enumerate(columns)
+		)
+	)
+
+
+def get_previous_year_columns(columns):
+	"""
+	Map each currency column's fieldname to the fieldname and label of the period a year earlier,
+	for the columns whose previous year period is also part of the report.
+	"""
+	labels = {row.get("fieldname"): row.get("label") for row in columns}
+	previous_year_columns = {}
 
 	for row in columns:
-		columns_new.append(row) 
-        
-		if flag and row.get("fieldtype")  == "Currency":
-
-			if filters.get("show_difference") in ["Monthly"]:
-				columns_new.append({
-					'fieldname': f'diff_with_{old_value.get("fieldname")}_and_{row.get("fieldname")}', 
-					'label': f'Diff W/{old_value.get("label")}', 
-					'fieldtype': 'Currency', 
-					'options': 'currency', 
-					'width': 150
-				})
-				columns_new.append({
-						'fieldname': f'percent_with_{old_value.get("fieldname")}_and_{row.get("fieldname")}',
-						'label': f'Percent Diff W/{old_value.get("label")}', 
-						'fieldtype': 'Percent', 
-						'width': 150
-				})	
-
-			if filters.get("show_difference") in ["Yearly"]:
-			
-				month = row.get("fieldname").split("_")
-				
-				if len(month) < 2:
-					continue 
-		
-				month = f"{month[0]}_{int(month[1])-1}"
-
-				month_name = row.get("label").split(" ")
-				#frappe.msgprint(f"{month_name}")
-				month_name = f"{month_name[0]} {int(month_name[1])-1}"
-				#frappe.msgprint(f"{month_name}")
-
-		
-				columns_new.append({
-					'fieldname': f'diff_with_{month}_and_{row.get("fieldname")}', 
-					'label': f'Diff W/{month_name}', 
-					'fieldtype': 'Currency', 
-					'options': 'currency', 
-					'width': 150
-				})
-				columns_new.append({
-						'fieldname': f'percent_diff_with_{month_name}_and_{row.get("fieldname")}',
-						'label': f'Percent Diff W/{month_name}', 
-						'fieldtype': 'Percent', 
-						'width': 150
-				})
-				
-		if row.get("fieldtype")  == "Currency":
-			flag = True
-		
-		old_value = row
-
-	columns = columns_new
-
-	# frappe.msgprint(f"{columns}")
-
-	return columns
+		if row.get("fieldtype") != "Currency":
+			continue
+
+		fieldname = row.get("fieldname")
+		period, sep, year = fieldname.rpartition("_")
+		if not (period and year.isdigit()):
+			continue
+
+		previous_year_fieldname = f"{period}_{int(year) - 1}"
+		if previous_year_fieldname in labels:
+			previous_year_columns[fieldname] = (previous_year_fieldname, labels[previous_year_fieldname])
+
+	return previous_year_columns
+
+
+def expand_difference_columns(row, compared_column):
+	"""Yield the column followed by its difference and percent columns against `compared_column`."""
+	yield row
+
+	if row.get("fieldtype") != "Currency" or not compared_column:
+		return
+
+	fieldname = row.get("fieldname")
+	from_fieldname, from_label = compared_column
+
+	yield {
+		'fieldname': f'diff_with_{from_fieldname}_and_{fieldname}',
+		'label': f'Diff W/{from_label}',
+		'fieldtype': 'Currency',
+		'options': 'currency',
+		'width': 150,
+		'from_fieldname': from_fieldname,
+		'to_fieldname': fieldname,
+	}
+	yield {
+		'fieldname': f'percent_with_{from_fieldname}_and_{fieldname}',
+		'label': f'Percent Diff W/{from_label}',
+		'fieldtype': 'Percent',
+		'width': 150,
+		'from_fieldname': from_fieldname,
+		'to_fieldname': fieldname,
+	}
+
 
 def check_opening_balance(asset, liability, equity, income, expense):
 	# Check if previous year balance sheet closed
-	opening_balance = 0
+	opening_balance = 0.0
 	float_precision = cint(frappe.db.get_default("float_precision")) or 2
 	if asset:
-		opening_balance = flt(asset[-1].get("opening_balance", 0), float_precision)
+		opening_balance = asset[-1].get("opening_balance") or 0.0
 	if liability:
-		opening_balance -= flt(liability[-1].get("opening_balance", 0), float_precision)
+		opening_balance -= liability[-1].get("opening_balance") or 0.0
 	if equity:
-		opening_balance -= flt(equity[-1].get("opening_balance", 0), float_precision)
+		opening_balance -= equity[-1].get("opening_balance") or 0.0
 
 	if income:
-		opening_balance -= flt(income[-1].get("opening_balance", 0), float_precision)
+		opening_balance -= income[-1].get("opening_balance") or 0.0
 	if expense:
-		opening_balance -= flt(expense[-1].get("opening_balance", 0), float_precision)
+		opening_balance -= expense[-1].get("opening_balance") or 0.0
 
 	opening_balance = flt(opening_balance, float_precision)
 	if opening_balance:
@@ -284,21 +322,24 @@ def get_report_summary(
 	if filters.get("accumulated_in_group_company"):
 		period_list = get_filtered_list_for_consolidated_report(filters, period_list)
 
-	for period in period_list:
-		key = period if consolidated else period.key
-		if asset:
-			net_asset += asset[-2].get(key)
-		if liability and liability[-1] == {}:
-			net_liability += liability[-2].get(key)
-		if equity and equity[-1] == {}:
-			net_equity += equity[-2].get(key)
-		if income and income[-1] == {}:
-			net_income += income[-2].get(key)
-		if expense and expense[-1] == {}:
-			net_expense += expense[-2].get(key)
+	# Only the total row (second last) of each root type feeds the summary
+	asset_row = asset[-2] if asset else {}
+	liability_row = liability[-2] if liability and liability[-1] == {} else {}
+	equity_row = equity[-2] if equity and equity[-1] == {} else {}
+	income_row = income[-2] if income and income[-1] == {} else {}
+	expense_row = expense[-2] if expense and expense[-1] == {} else {}
+
+	keys = period_list if consolidated else [period.key for period in period_list]
+
+	for key in keys:
+		net_asset += asset_row.get(key) or 0.0
+		net_liability += liability_row.get(key) or 0.0
+		net_equity += equity_row.get(key) or 0.0
+		net_income += income_row.get(key) or 0.0
+		net_expense += expense_row.get(key) or 0.0
 
 		if provisional_profit_loss:
-			net_provisional_profit_loss += provisional_profit_loss.get(key)
+			net_provisional_profit_loss += provisional_profit_loss.get(key) or 0.0
 
 	return [
 		{"value": net_asset, "label": _("Total Asset"), "datatype": "Currency", "currency": currency},
@@ -316,32 +357,20 @@ def get_report_summary(
 
 def get_chart_data(filters, columns, asset, liability, equity, income, expense, currency):
 	labels = [d.get("label") for d in columns[2:]]
-
-	asset_data, liability_data, equity_data, income_data, expense_data = [], [],[], [], []
-
-	for p in columns[2:]:
-		if asset:
-			asset_data.append(asset[-2].get(p.get("fieldname")))
-		if liability:
-			liability_data.append(liability[-2].get(p.get("fieldname")))
-		if equity:
-			equity_data.append(equity[-2].get(p.get("fieldname")))
-		if income:
-			income_data.append(income[-2].get(p.get("fieldname")))
-		if expense:
-			expense_data.append(expense[-2].get(p.get("fieldname")))
+	fieldnames = [d.get("fieldname") for d in columns[2:]]
 
 	datasets = []
-	if asset_data:
-		datasets.append({"name": _("Assets"), "values": asset_data})
-	if liability_data:
-		datasets.append({"name": _("Liabilities"), "values": liability_data})
-	if equity_data:
-		datasets.append({"name": _("Equity"), "values": equity_data})
-	if income_data:
-		datasets.append({"name": _("Income"), "values": income_data})
-	if expense_data:
-		datasets.append({"name": _("Expense"), "values": expense_data})
+	for name, rows in (
+		(_("Assets"), asset),
+		(_("Liabilities"), liability),
+		(_("Equity"), equity),
+		(_("Income"), income),
+		(_("Expense"), expense),
+	):
+		if rows and fieldnames:
+			# Each root type is charted from its total row (second last)
+			total_row = rows[-2]
+			datasets.append({"name": name, "values": [total_row.get(f) for f in fieldnames]})
 
 	chart = {"data": {"labels": labels, "datasets": datasets}}
 